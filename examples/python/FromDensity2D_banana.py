@@ -1,40 +1,51 @@
+import os
+# one pinned Kokkos thread per available CPU, unless set by the caller (must precede importing mpart)
+os.environ.setdefault('KOKKOS_NUM_THREADS', str(len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1))
+os.environ.setdefault('OMP_PROC_BIND', 'close')
+os.environ.setdefault('OMP_PLACES', 'threads')
+
 from mpart import *
 import numpy as np
 from scipy.optimize import minimize
 import matplotlib.pyplot as plt
-from scipy.stats import multivariate_normal
 import time
 
+print('Kokkos is using', Concurrency(), 'threads')
+
+# Set MPART_EXAMPLE_PLOT=0 to skip the figures, e.g. when benchmarking or in CI
+PLOT = os.environ.get('MPART_EXAMPLE_PLOT', '1') == '1'
+
 
 # Make reference samples for training
+rng = np.random.default_rng(0)
 num_points = 1000
-x = np.random.randn(2,num_points)
+x = rng.standard_normal((2,num_points))  # float64: MParT's bindings only take double precision
 
 # Make target samples for testing
-test_x = np.random.randn(2,10000)
+if PLOT:
+    test_x = rng.standard_normal((2,10000))
 
 
 def target_logpdf(x):
-  rv1 = multivariate_normal(np.zeros(1),np.eye(1))
-  rv2 = multivariate_normal(np.zeros(1),np.eye(1))
-  logpdf1 = rv1.logpdf(x[0])
-  logpdf2 = rv2.logpdf(x[1]-x[0]**2)
-  logpdf = logpdf1 + logpdf2
-  return logpdf
+  return -0.5*(x[0]**2 + (x[1]-x[0]**2)**2) - np.log(2*np.pi)
 
 
-def target_grad_logpdf(x):
-  grad1 = -x[0,:] + (2*x[0,:]*(x[1,:]-x[0,:]**2))
-  grad2 = (x[0,:]**2-x[1,:])
-  return np.vstack((grad1,grad2))
+def target_grad_logpdf(x, out=None):
+  if out is None:
+    out = np.empty_like(x)
+  d = x[1,:] - x[0,:]**2
+  np.multiply(2*x[0,:], d, out=out[0])
+  out[0] -= x[0,:]
+  np.negative(d, out=out[1])
+  return out
 
 
-Ngrid = 100
-ref_distribution = multivariate_normal(np.zeros(2),np.eye(2))  #standard normal
-t = np.linspace(-5,5,Ngrid)
-grid = np.meshgrid(t,t)
-target_logpdf_at_grid = target_logpdf([grid[0].flatten(),grid[1].flatten()]).reshape(Ngrid,Ngrid)
-target_pdf_at_grid = np.exp(target_logpdf_at_grid)
+if PLOT:
+    Ngrid = 100
+    grid = np.mgrid[-5:5:Ngrid*1j, -5:5:Ngrid*1j]
+    grid_points = grid.reshape(2,-1)  # (2,Ngrid**2) view of the grid points
+    target_logpdf_at_grid = target_logpdf(grid_points).reshape(Ngrid,Ngrid)
+    target_pdf_at_grid = np.exp(target_logpdf_at_grid)
 
 
 # Set-up map and initize map coefficients
@@ -46,11 +57,12 @@ transport_map.SetCoeffs(coeffs)
 
 
 # Before optimization plot
-plt.figure()
-plt.contour(*grid, target_pdf_at_grid)
-plt.scatter(test_x[0],test_x[1], facecolor='blue', alpha=0.1, label='Reference samples')
-plt.legend()
-plt.show()
+if PLOT:
+    plt.figure()
+    plt.contour(*grid, target_pdf_at_grid)
+    plt.scatter(test_x[0],test_x[1], facecolor='blue', alpha=0.1, label='Reference samples')
+    plt.legend()
+    plt.show()
 
 
 # KL divergence objective
@@ -59,16 +71,22 @@ def obj(coeffs, transport_map, x):
     map_of_x = transport_map.Evaluate(x)
     logpdf= target_logpdf(map_of_x)
     log_det = transport_map.LogDeterminant(x)
-    return -np.sum(logpdf + log_det)/num_points
+    return -(logpdf.mean() + log_det.mean())
 
 
-def grad_obj(coeffs, transport_map, x):
+# work array for the sensitivities, reused across iterations
+sens_vecs = np.empty((2,num_points))
+
+# KL divergence objective and its gradient, sharing one map evaluation
+def obj_and_grad(coeffs, transport_map, x):
     transport_map.SetCoeffs(coeffs)
     map_of_x = transport_map.Evaluate(x)
-    sens_vecs = target_grad_logpdf(map_of_x)
+    logpdf = target_logpdf(map_of_x)
+    log_det = transport_map.LogDeterminant(x)
+    target_grad_logpdf(map_of_x, out=sens_vecs)
     grad_logpdf = transport_map.CoeffGrad(x, sens_vecs)
     grad_log_det = transport_map.LogDeterminantCoeffGrad(x)
-    return -np.sum(grad_logpdf + grad_log_det, 1)/num_points
+    return -(logpdf.mean() + log_det.mean()), -(grad_logpdf.mean(1) + grad_log_det.mean(1))
 
 
 # Print initial coeffs and objective
@@ -78,9 +96,11 @@ print('and error: {:.2E}'.format(obj(transport_map.CoeffMap(), transport_map, x)
 print('==================')
 
 start=time.time()
-options={'gtol': 1e-4, 'disp': True}
-res = minimize(obj, transport_map.CoeffMap(), args=(transport_map, x), jac=grad_obj, method='BFGS', options=options)
+options={'gtol': 1e-4}
+res = minimize(obj_and_grad, transport_map.CoeffMap(), args=(transport_map, x), jac=True, method='L-BFGS-B', options=options)
+transport_map.SetCoeffs(res.x)
 dt = time.time()-start
+print('{} ({} iterations, objective {:.2E})'.format(res.message, res.nit, res.fun))
 
 # Print final coeffs and objective
 print('Final coeffs')
@@ -90,9 +110,10 @@ print('==================')
 
 
 # After optimization plot
-map_of_test_x = transport_map.Evaluate(test_x)
-plt.figure()
-plt.contour(*grid, target_pdf_at_grid)
-plt.scatter(map_of_test_x[0],map_of_test_x[1], facecolor='blue', alpha=0.1, label='Push-forward samples')
-plt.legend()
-plt.show()
+if PLOT:
+    map_of_test_x = transport_map.Evaluate(test_x)
+    plt.figure()
+    plt.contour(*grid, target_pdf_at_grid)
+    plt.scatter(map_of_test_x[0],map_of_test_x[1], facecolor='blue', alpha=0.1, label='Push-forward samples')
+    plt.legend()
+    plt.show()